@@ -16,6 +16,7 @@ from enum import (
 	auto
 )
 from collections import namedtuple
+from os import sched_getaffinity
 
 class LgFormats(Enum):
 
@@ -113,5 +114,19 @@ class LgException(Exception):
 		else:
 			return str(self.error)
 
+# Number of CPUs we may actually use, respecting our affinity mask
+# (taskset, cpusets) and a cgroup v2 CPU quota (e.g. containers),
+# used for sizing our thread pools.
+def lg_get_num_cpus():
+	num_cpus = len(sched_getaffinity(0))
+	try:
+		with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+			quota, period = cpu_max.read().split()
+		if quota != "max":
+			num_cpus = min(num_cpus, -(-int(quota) // int(period)))
+	except (OSError, ValueError):
+		pass
+	return max(1, num_cpus)
+
 LgRgainTrackData = namedtuple("LgRgainTrackResult", ["filename", "gain", "peak", "ref_lvl"])
 LgRgainAlbumData = namedtuple("LgRgainAlbumResult", ["gain", "peak"])
@@ -32,7 +32,8 @@ from libguard import (
 	LgErr,
 	LgException,
 	LgRgainTrackData,
-	LgRgainAlbumData
+	LgRgainAlbumData,
+	lg_get_num_cpus
 )
 from libguard.lgfile import (
 	LgFile,
@@ -45,6 +46,15 @@ from libguard.lgrgainprocessor import LgRgainProcessor
 from abc import ABC
 from gi.repository import GLib
 
+# Per-file work (creating file objects, updating tags, integrity checks)
+# of all directories goes through this pool, instead of spinning up
+# a new one on every directory. Most of it is blocking on I/O or on the
+# external integrity checkers, so run as many as we have CPUs. Note
+# that tasks submitted here must not wait on other tasks of the pool.
+_FILE_WORKERS = lg_get_num_cpus()
+_file_pool = concurrent.futures.ThreadPoolExecutor(max_workers = _FILE_WORKERS,
+						   thread_name_prefix = "lg-file")
+
 class LgDirectory(ABC):
 
 	def __init__(self, dentry, parent, opts):
@@ -76,25 +86,32 @@ class LgDirectory(ABC):
 			del direntries
 			return
 
-		for entry in direntries:
-			if entry.is_file():
-				try:
-					fentry = LgFile(entry, self.options)
-				except LgException as status:
-					init_errors.append(status.error)
-				else:
-					if isinstance(fentry, LgAudioFile):
-						self.has_audio = True
-						self.audio_files.append(fentry)
-					elif isinstance(fentry, LgArtworkFile):
-						self.has_artwork = True
-						self.artwork_files.append(fentry)
-					elif isinstance(fentry, LgTextFile):
-						self.has_text = True
-						self.text_files.append(fentry)
-					elif isinstance(fentry, LgTextFile):
-						self.has_video = True
-						self.video_files.append(fentry)
+		# Creating the file objects means typechecking them and opening
+		# audio files with mutagen, all of it blocking on the filesystem,
+		# so do it in parallel. We get results back in the same order we
+		# submitted them, so the ordering above is preserved.
+		fentries = [entry for entry in direntries if entry.is_file()]
+		results = list(_file_pool.map(self.__new_file, fentries))
+		fentries.clear()
+		del fentries
+
+		for fentry, status in results:
+			if status is not None:
+				init_errors.append(status)
+			elif isinstance(fentry, LgAudioFile):
+				self.has_audio = True
+				self.audio_files.append(fentry)
+			elif isinstance(fentry, LgArtworkFile):
+				self.has_artwork = True
+				self.artwork_files.append(fentry)
+			elif isinstance(fentry, LgTextFile):
+				self.has_text = True
+				self.text_files.append(fentry)
+			elif isinstance(fentry, LgTextFile):
+				self.has_video = True
+				self.video_files.append(fentry)
+		results.clear()
+		del results
 		direntries.clear()
 		del direntries
 
@@ -141,6 +158,12 @@ class LgDirectory(ABC):
 			self.__init__(dentry, parent, opts)
 
 
+	def __new_file(self, entry):
+		try:
+			return LgFile(entry, self.options), None
+		except LgException as status:
+			return None, status.error
+
 	def __enter__(self):
 		return self
 
@@ -619,10 +642,9 @@ class LgAlbumDirectory(LgDirectory):
 		# the whole album. Note that if we are here all files have
 		# the same album_gain value, so if it's None, it's None for
 		# everyone.
-		if (
-			self.album_gain is not None
-			and LgOpts.OFORCERGAIN not in self.options
-		   ):
+		force_rgain = LgOpts.OFORCERGAIN in self.options
+		if self.album_gain is not None and not force_rgain:
+			del force_rgain
 			return LgErr.EOK
 
 		filenames = list()
@@ -634,9 +656,10 @@ class LgAlbumDirectory(LgDirectory):
 			tgain, tpeak, again, apeak, ref_lvl = fentry.get_rgain_values()
 			if tgain is None or tpeak is None:
 				filenames.append(fentry.get_path())
-			elif LgOpts.OFORCERGAIN in self.options:
+			elif force_rgain:
 				filenames.append(fentry.get_path())
 			del tgain, tpeak, again, apeak, ref_lvl
+		del force_rgain
 
 		# Are there any files that need updating or we didn't add
 		# anything above (e.g. we are in a folder with standalone
@@ -680,24 +703,52 @@ class LgAlbumDirectory(LgDirectory):
 			debug("ReplayGain info for disc %s:\n\tGain: %s, Peak: %s",
 			      self.dentry.name, again, apeak)
 
+		# Match results to our files before touching any of them
+		updates = list()
 		for results in track_results:
 			debug("ReplayGain info for track %s:\n\tGain: %s, Peak: %s, Ref.lvl: %s",
 			      results.filename, results.gain, results.peak, results.ref_lvl)
 			fentry = self._get_track_by_filename(results.filename)
 			if fentry is None:
 				error("Rgain to local file list mismatch !:\n\t%s", results.filename)
-				del track_results, again, apeak, results
+				updates.clear()
+				del updates, track_results, again, apeak, results
 				return LgErr.ERGAIN
+			updates.append((fentry, results))
+			del fentry
 
-			ret = fentry.update_rgain_values(results.gain, results.peak,
+		# Saving the tags may rewrite the whole file and it's followed
+		# by a full integrity check of the result, all of it I/O and
+		# external processes, so update the tracks in parallel.
+		ret = LgErr.EOK
+		futures = list()
+		for fentry, results in updates:
+			futures.append(_file_pool.submit(fentry.update_rgain_values,
+							 results.gain, results.peak,
 							 again, apeak,
-							 results.ref_lvl)
-
-			del fentry
-			if ret is not LgErr.EOK:
-				del track_results, again, apeak, results, ret
-				return LgErr.ERGAIN
-			del ret
+							 results.ref_lvl))
+		try:
+			for future in concurrent.futures.as_completed(futures):
+				if future.result() is not LgErr.EOK:
+					ret = LgErr.ERGAIN
+					break
+		finally:
+			# Stop at the first failure (or exception) as if we were
+			# going through the tracks one by one, don't touch any
+			# more files and let the ones already being written finish
+			# before we return/raise.
+			for future in futures:
+				future.cancel()
+			concurrent.futures.wait(futures)
+		futures.clear()
+		del futures
+		updates.clear()
+		del updates
+
+		if ret is not LgErr.EOK:
+			del track_results, again, apeak, results, ret
+			return LgErr.ERGAIN
+		del ret
 
 		# Write changes to disk so that verify runs after this
 		sync()
@@ -720,11 +771,12 @@ class LgAlbumDirectory(LgDirectory):
 	
 	def verify(self):
 		# Verify the integrity of the audio files on this album
-		with concurrent.futures.ThreadPoolExecutor(max_workers = 4) as executor:
-			futures = list()
-			for fentry in self.audio_files:
-				futures.append(executor.submit(self.__verify_one, fentry))
-			executor.shutdown(wait=True)
+		futures = list()
+		for fentry in self.audio_files:
+			futures.append(_file_pool.submit(self.__verify_one, fentry))
+		concurrent.futures.wait(futures)
+		futures.clear()
+		del futures
 
 		# We are done processing audio files and all entries on
 		# self.audio_files are finalized, clear the list as well.
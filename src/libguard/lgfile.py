@@ -10,11 +10,17 @@
 #
 
 from abc import ABC
+from collections.abc import MutableSequence
 import time
 from os import (
 	setxattr,
 	getxattr, 
 	removexattr,
+	open as os_open,
+	stat as os_stat,
+	pread,
+	close,
+	O_RDONLY,
 	path
 )
 from logging import (
@@ -32,6 +38,7 @@ from libguard import (
 )
 import mimetypes
 import magic
+from threading import local
 
 # For audio files
 from subprocess import (
@@ -39,6 +46,7 @@ from subprocess import (
 	CalledProcessError,
 	DEVNULL
 )
+from shutil import which
 from mutagen import MutagenError
 from mutagen.easyid3 import EasyID3
 from mutagen.mp3 import EasyMP3
@@ -46,12 +54,106 @@ from mutagen.flac import FLAC
 from mutagen.oggvorbis import OggVorbis
 from mutagen.wavpack import WavPack
 
+# Mime types for the extensions we expect to find on the library, so that
+# we don't have to go through mimetypes (and the system's mime.types, that
+# may e.g. map .wv to something other than WavPack) for every file. Anything
+# else falls back to mimetypes.guess_type().
+_EXT_MIME = {
+	".mp3": "audio/mpeg",
+	".flac": "audio/flac",
+	".ogg": "audio/ogg",
+	".wv": "audio/x-wavpack",
+	".jpg": "image/jpeg",
+	".jpeg": "image/jpeg",
+	".png": "image/png",
+	".gif": "image/gif",
+	".pdf": "application/pdf",
+	".txt": "text/plain",
+	}
+
+# Names of the xattrs we use for memoizing typecheck/verification results
+_XATTR_TYPECHECK_TS = "user.lguard_typecheck_ts"
+_XATTR_FTYPE = "user.lguard_ftype"
+_XATTR_VERIFICATION_TS = "user.lguard_verification_ts"
+# Used by older versions
+_XATTR_OLD_CHECK_TS = "user.libfile_check_ts"
+
+# Extensions we trust without asking libmagic (see get_type())
+_EXT_FASTPATH = {
+	".mp3": LgFormats.AUDIO,
+	".flac": LgFormats.AUDIO,
+	".ogg": LgFormats.AUDIO,
+	".wv": LgFormats.AUDIO,
+	}
+
+# Album info tag names for the formats we handle, in lookup order.
+# For the totals the first one (OGG/FLAC) holds just the total, the
+# rest (ID3, its APEv2 equivalent, Mutagen's EasyID3 representation)
+# are in "position/total" form.
+_DISCTOTAL_KEYS = ("DISCTOTAL", "TPOS", "Disc", "Discnumber")
+_TRACKTOTAL_KEYS = ("TRACKTOTAL", "TRCK", "Track", "Tracknumber")
+# OGG/FLAC/APEv2/EasyMP3 and then ID3 in TXXX form
+_ALBUMID_KEYS = ("musicbrainz_albumid", "TXXX:MusicBrainz Album Id")
+_ALBUMGAIN_KEYS = ("replaygain_album_gain", "TXXX:replaygain_album_gain")
+_RELEASEGROUPID_KEYS = ("musicbrainz_releasegroupid", "TXXX:MusicBrainz Release Group Id")
+
+def _get_tag(tags, keys):
+	for key in keys:
+		value = tags.get(key)
+		if value is not None:
+			# Most tag types hold a list of values (APEv2 text
+			# values are a MutableSequence too)
+			if isinstance(value, MutableSequence):
+				value = value[0]
+			return key, value
+	return None, None
+
+def _get_first_from_tags(tags, keys):
+	return _get_tag(tags, keys)[1]
+
+def _get_total_from_tags(tags, keys):
+	key, value = _get_tag(tags, keys)
+	if value is None:
+		return None
+	elif key is keys[0]:
+		return int(value)
+	try:
+		return int(str(value).split('/')[1])
+	except IndexError:
+		return value
+
+# Formatters for the ReplayGain tag values we write, bound once here
+# instead of parsing a format string on every tag update.
+_RGAIN_GAIN_FMT = "{:.8f} dB".format
+_RGAIN_PEAK_FMT = "{:.8f}".format
+_RGAIN_REFLVL_FMT = "{:.1f} dB".format
+
+# Files get typechecked from a thread pool and python-magic serializes
+# all calls on a shared handle, give each thread its own libmagic
+# handle instead (loaded on first use).
+_magic_tls = local()
+
+def _get_magic():
+	handle = getattr(_magic_tls, "handle", None)
+	if handle is None:
+		handle = magic.Magic(mime=True)
+		_magic_tls.handle = handle
+	return handle
+
+# libmagic only needs the start of a file to identify it, this is
+# how much we read for it.
+_MAGIC_HEAD_SIZE = 8192
+
 #
 # Top class (entry point)
 #
 
 class LgFile(ABC):
 
+	# We create one of these for every file in the library, use
+	# slots so that instances don't carry around a __dict__.
+	__slots__ = ("fentry", "options", "_dead")
+
 	# Xattr manipulation:
 	# To save time we mark files we've already typechecked/verified through
 	# user xattrs on the filesystem. For typecheck we save last ctime (+offset)
@@ -61,45 +163,45 @@ class LgFile(ABC):
 	# we'll perform the verification again.
 	@staticmethod
 	def get_type_from_xattrs(fentry):
-		stat = fentry.stat()	
-		ctime = int(stat.st_ctime)
-		ret = None
 		try:
-			check_ts = int(getxattr(fentry.path, b"user.lguard_typecheck_ts"))
+			check_ts = int(getxattr(fentry.path, _XATTR_TYPECHECK_TS))
 		except OSError:
 			debug("No typecheck_ts present, typecheck needed:\n\t%s",
 			      fentry.path);
-			del stat, ctime, ret
 			return None
 
+		stat = fentry.stat()	
+		ctime = int(stat.st_ctime)
+		ret = None
+
 		debug("Typecheck_ts check:\n\t%s\n\t(ctime: %d, check_ts: %d)",
 		      fentry.path, ctime, check_ts)
 
 		if ctime <= check_ts:
 			try:
-				ftype = str(getxattr(fentry.path, b"user.lguard_ftype").decode("ascii"))
+				ftype = str(getxattr(fentry.path, _XATTR_FTYPE).decode("ascii"))
 			except OSError:
 				warning("Typecheck timestamp present but no ftype !: %s", fentry.path)
-				removexattr(fentry.path, b"user.lguard_typecheck_ts")
-				del stat, ctime, ret, check_ts
+				removexattr(fentry.path, _XATTR_TYPECHECK_TS)
 				return None
 			try:
 				ret = LgFormats(str(ftype))
 			except ValueError:
 				warning("Previous typecheck set an invalid ftype!:\n\t%s", fentry.path)
-				removexattr(fentry.path, b"user.lguard_typecheck_ts")
-				removexattr(fentry.path, b"user.lguard_ftype")
-				del stat, ctime, check_ts, ftype
+				removexattr(fentry.path, _XATTR_TYPECHECK_TS)
+				removexattr(fentry.path, _XATTR_FTYPE)
 				return None
 
-			debug("Got saved type (%s):\n\t%s", str(ret), fentry.path)
-			del stat, ctime, check_ts, ftype
+			debug("Got saved type (%s):\n\t%s", ret, fentry.path)
 			return ret
 		else:
 			debug("File metadata changed, should typecheck again:\n\t%s", fentry.path)
-			removexattr(fentry.path, b"user.lguard_typecheck_ts")
-			removexattr(fentry.path, b"user.lguard_ftype")
-		del stat, ctime, ret, check_ts
+			removexattr(fentry.path, _XATTR_TYPECHECK_TS)
+			# We may have a typecheck timestamp without ftype
+			try:
+				removexattr(fentry.path, _XATTR_FTYPE)
+			except OSError:
+				pass
 		return None
 			
 	@staticmethod
@@ -108,71 +210,98 @@ class LgFile(ABC):
 		# safe side (since different file systems have different resolutions for
 		# ctime) add 1s to make sure we are >= updated ctime.
 		new_ctime = int(time.time()) + 1
-		setxattr(fentry.path, b"user.lguard_typecheck_ts", str(new_ctime).encode("ascii"))
-		setxattr(fentry.path, b"user.lguard_ftype", str(ftype).encode("ascii"))
+		setxattr(fentry.path, _XATTR_TYPECHECK_TS, b"%d" % new_ctime)
+		setxattr(fentry.path, _XATTR_FTYPE, str(ftype).encode("ascii"))
 		debug("Typecheck_ts update:\n\t%s\n\t(typecheck_ts: %d, type: %s)",
 		      fentry.path, new_ctime, ftype)
-		del new_ctime
 		return
 
 	@staticmethod
-	def get_verification_ts_from_xattrs(fentry):
+	def get_verification_ts_from_xattrs(fentry, mtime = None):
+		# Most files on the library are already verified, for them this
+		# is a single getxattr(). Files we haven't verified yet also pay
+		# for the old name's check below, listing the xattrs first would
+		# save that but cost verified files an extra syscall instead.
 		try:
-			check_ts = int(getxattr(fentry.path, b"user.lguard_verification_ts").decode("ascii"))
+			return int(getxattr(fentry.path, _XATTR_VERIFICATION_TS))
 		except OSError:
-			# Check for the older attr name, if present remove it and use the new one
-			# TODO: remove this once library is up to date
-			try:
-				check_ts = float(getxattr(fentry.path, b"user.libfile_check_ts").decode("ascii"))
-			except OSError:
-				debug("No check_ts present, check needed:\n\t%s", fentry.path);
-				return None
-			else:
-				removexattr(fentry.path, b"user.libfile_check_ts")
-				del check_ts
-				return LgFile.update_verification_ts_on_xattrs(fentry)
-		else:
-			return check_ts
+			pass
+		# Check for the older attr name, if present remove it and use the new one
+		# TODO: remove this once library is up to date
+		# (we don't need its value, removexattr() fails if it's not there)
+		try:
+			removexattr(fentry.path, _XATTR_OLD_CHECK_TS)
+		except OSError:
+			debug("No check_ts present, check needed:\n\t%s", fentry.path);
+			return None
+		return LgFile.update_verification_ts_on_xattrs(fentry, mtime)
 
 	@staticmethod
-	def update_verification_ts_on_xattrs(fentry):
-		stat = fentry.stat()
-		mtime = int(stat.st_mtime)
-		setxattr(fentry.path, b"user.lguard_verification_ts", str(mtime).encode("ascii"))
+	def update_verification_ts_on_xattrs(fentry, mtime = None):
+		# Callers that already got the file's mtime pass it
+		# here to avoid another stat().
+		if mtime is None:
+			mtime = int(fentry.stat().st_mtime)
+		setxattr(fentry.path, _XATTR_VERIFICATION_TS, b"%d" % mtime)
 		debug("Updated verification_ts (%d):\n\t%s", mtime, fentry.path)
 		# The above changed ctime re-set typecheck timestamp
 		new_ctime = int(time.time()) + 1
-		setxattr(fentry.path, b"user.lguard_typecheck_ts", str(new_ctime).encode("ascii"))
-		del stat, mtime
+		setxattr(fentry.path, _XATTR_TYPECHECK_TS, b"%d" % new_ctime)
 		return new_ctime
 
 	
 
 	@staticmethod
-	def get_type(fentry, opts):
+	def get_type(fentry, opts, fext = None):
+
+		if fext is None:
+			fext = path.splitext(fentry.name)[1]
 
-		# Try to determine the file's format from saved
-		# xattrs.
 		if not LgOpts.OFORCECHECK in opts:
+			# Audio files go through their format's integrity checker
+			# on verify(), that catches misnamed/broken files far better
+			# than libmagic, so trust their extension.
+			ext_type = _EXT_FASTPATH.get(fext.lower())
+			if ext_type is not None:
+				return ext_type
+
+			# Try to determine the file's format from saved
+			# xattrs.
 			saved_type = LgFile.get_type_from_xattrs(fentry)
 			if not (saved_type is None):
 				return saved_type
 
 		# Determine file's format the hard way
-	
-		fext = path.splitext(fentry.name)[1]
-		mimetype = mimetypes.guess_type(fentry.path)[0]
-		mimetype_magic = magic.from_file(fentry.path, mime=True)
+
+		# We may check this a few times below, opts don't change
+		# so only test the flag once.
+		dryrun = LgOpts.ODRYRUN in opts
+
+		mimetype = _EXT_MIME.get(fext.lower())
+		if mimetype is None:
+			mimetype = mimetypes.guess_type(fentry.path)[0]
+		# Hand libmagic just the file's head, from_file() would have it
+		# read (up to a whole MB) through large audio files for nothing.
+		fd = os_open(fentry.path, O_RDONLY)
+		try:
+			head = pread(fd, _MAGIC_HEAD_SIZE, 0)
+		finally:
+			close(fd)
+		# For empty files from_buffer() can't tell we're looking at
+		# an inode, keep reporting them as from_file() does.
+		if head:
+			mimetype_magic = _get_magic().from_buffer(head)
+		else:
+			mimetype_magic = "inode/x-empty"
 
 		if mimetype == None:
 			# Some text files don't have extensions so mimetypes will
 			# fail to guess the filetype, use magic to be sure.
 			if mimetype_magic != None:
-				mimetype_magic_major = mimetype_magic.split('/')[0]
+				mimetype_magic_major = mimetype_magic.partition('/')[0]
 				if mimetype_magic_major == "text":
-					if not LgOpts.ODRYRUN in opts:
+					if not dryrun:
 						LgFile.update_type_on_xattrs(fentry, LgFormats.TEXT)
-					del fext, mimetype, mimetype_magic
 					return LgFormats.TEXT
 				# We have two markers to indicate that writes to a directory should
 				# be ignored, and another marker to indicate that a directory should
@@ -184,24 +313,21 @@ class LgFile(ABC):
 					or fentry.name == "locked"
 					or fentry.name == "ignore"
 				     ):
-					if not LgOpts.ODRYRUN in opts:
+					if not dryrun:
 						LgFile.update_type_on_xattrs(fentry, LgFormats.TEXT)
-					del fext, mimetype, mimetype_magic
 					return LgFormats.TEXT
 				else:
 					error("Unknown file extension:\n\t%s", fentry.path)
 			else:
 				error("Unknown file type:\n\t%s", fentry.path)
-			del fext, mimetype, mimetype_magic
 			return None
 
 		if mimetype_magic == None:
 			error("Unknown magic value:\n\t%s", fentry.path)
-			del fext, mimetype, mimetype_magic
 			return None
 
-		mimetype_magic_major, mimetype_magic_minor = mimetype_magic.split('/')
-		mimetype_major, mimetype_minor = mimetype.split('/')
+		mimetype_magic_major, _, mimetype_magic_minor = mimetype_magic.partition('/')
+		mimetype_major, _, mimetype_minor = mimetype.partition('/')
 
 		if mimetype != mimetype_magic:
 			if mimetype_major == mimetype_magic_major:
@@ -243,9 +369,6 @@ class LgFile(ABC):
 					# mess and raise the error flag.
 					error("Inconsistent file format:\n\t%s\n\t(is %s vs %s)",
 					      fentry.path, mimetype_magic, mimetype)
-					del fext, mimetype, mimetype_magic
-					del C, mimetype_magic_minor
-					del mimetype_major, mimetype_minor
 					return None
 
 		if mimetype_major == "audio":
@@ -261,41 +384,39 @@ class LgFile(ABC):
 			error("Unhandled file type:\n\t%s\n\t(%s)", fentry.path, mimetype)
 			ret = None
 
-		if not LgOpts.ODRYRUN in opts and ret is not None:
+		if not dryrun and ret is not None:
 			LgFile.update_type_on_xattrs(fentry, ret)
 
-		del fext, mimetype, mimetype_magic
-		del mimetype_magic_major, mimetype_magic_minor
-		del mimetype_major, mimetype_minor
 		return ret
 
 	def __new__(cls, fentry, opts):
+		# Both get_type() and LgAudioFile.__new__ need the
+		# file's extension, only split it once.
+		fext = path.splitext(fentry.name)[1]
+
 		# Determine file's format
-		ftype = LgFile.get_type(fentry, opts)
+		ftype = LgFile.get_type(fentry, opts, fext)
 		if ftype is None:
 			raise LgException(LgErr.EINVFORMAT, fentry)
 
-		debug("Got file type (%s):\n\t%s", str(ftype), fentry.path)
+		debug("Got file type (%s):\n\t%s", ftype, fentry.path)
 
-		if ftype == LgFormats.AUDIO:
-			del ftype
-			return LgAudioFile.__new__(LgAudioFile, fentry, opts)
-		# We have some booklets in PDF format
-		elif ftype == LgFormats.ARTWORK:
-			del ftype
-			return super().__new__(LgArtworkFile)
-		elif ftype == LgFormats.TEXT:
-			del ftype
-			return super().__new__(LgTextFile)
-		elif ftype == LgFormats.VIDEO:
-			del ftype
-			return super().__new__(LgVideoFile)
-		else:
-			del ftype
+		# Map the format to its class through _TYPE_TO_CLASS, it's
+		# filled in at the end of this module once all subclasses
+		# are declared.
+		ftype_class = LgFile._TYPE_TO_CLASS.get(ftype)
+		if ftype_class is None:
 			error("Unhandled file type:\n\t%s", fentry.path)
 			raise LgException(LgErr.EINVFORMAT, fentry)
-		
+		# Audio files have their own subclasses, let LgAudioFile
+		# pick the right one.
+		elif ftype_class is LgAudioFile:
+			return LgAudioFile.__new__(LgAudioFile, fentry, opts, fext)
+		else:
+			return super().__new__(ftype_class)
+
 	def __init__(self, fentry, opts):
+		self._dead = False
 		self.fentry = fentry
 		self.options = opts
 
@@ -303,57 +424,54 @@ class LgFile(ABC):
 		return self
 
 	def __exit__(self, exc_type, exc_value, traceback):
-		# Remove references to fentry and opts
-		# and clean up the memory of the local
-		# variables.
+		# Drop our references to fentry and opts,
+		# a dead file won't need them.
 		self.fentry = None
-		del self.fentry
 		self.options = None
-		del self.options
 		# Become a dead file
-		self.__class__ = _LgRipFile
+		self._dead = True
 		return True
 
+	# A dead file throws exceptions everytime
+	# one of its functions are called
+	def _check_alive(self):
+		if self._dead:
+			raise LgException(LgErr.ERIP, None)
+
 	def verify(self):
+		self._check_alive()
 		return LgErr.EOK
 
 	def get_path(self):
+		self._check_alive()
 		return self.fentry.path
 
 	def get_name(self):
+		self._check_alive()
 		return self.fentry.name
 
-#
-# A dead file that throws exceptions evrytime
-# one of its functions are called
-#
-
-class _LgRipFile(LgFile):
-	def verify(self):
-		raise LgException(LgErr.ERIP, None)
-
-	def get_path(self):
-		raise LgException(LgErr.ERIP, None)
-
-	def get_name(self):
-		raise LgException(LgErr.ERIP, None)
-
 #
 # Small subclasses
 #
 
 class LgVideoFile(LgFile):
 
+	__slots__ = ()
+
 	def __init__(self, fentry, opts):
 		super().__init__(fentry, opts)
 
 class LgArtworkFile(LgFile):
 
+	__slots__ = ()
+
 	def __init__(self, fentry, opts):
 		super().__init__(fentry, opts)
 
 class LgTextFile(LgFile):
 
+	__slots__ = ()
+
 	def __init__(self, fentry, opts):
 		super().__init__(fentry, opts)
 		# We know there are issues with this directory and we want them
@@ -368,67 +486,80 @@ class LgTextFile(LgFile):
 
 class LgAudioFile(LgFile):
 
-	def __new__(cls, fentry, opts):
-		# Determine file's format
-		try:
+	__slots__ = ("mutagen_handle", "mtime")
+
+	# Per-format integrity checker and mutagen class used
+	# for accessing the file's tags, set by each subclass
+	verify_cmd = None
+	verify_cmd_args = None
+	mutagen_class = None
+
+	# Whether the format keeps its tags in a padded block ahead of the
+	# audio data, that mutagen rewrites in place if the new tags fit.
+	# See update_rgain_values().
+	tags_padded_in_place = False
+
+	# Absolute path of verify_cmd, looked up once per subclass
+	# the first time we need it, see _get_verify_cmd_path()
+	_verify_cmd_path = None
+
+	# Tag keys for ReplayGain info
+	tgain_tag_key = "replaygain_track_gain"
+	tpeak_tag_key = "replaygain_track_peak"
+	again_tag_key = "replaygain_album_gain"
+	apeak_tag_key = "replaygain_album_peak"
+	reflvl_tag_key = "replaygain_reference_loudness"
+
+	def __new__(cls, fentry, opts, fext = None):
+		# Determine file's format, LgFile.__new__ passes
+		# the extension it already got.
+		if fext is None:
 			fext = path.splitext(fentry.name)[1]
-		except IndexError:
-			error("Unhandled audio file type:\n\t%s", fentry.path)
-			raise LgException(LgErr.EINVFORMAT, fentry)
 
-		if fext == ".mp3":
-			del fext
-			return super(LgFile, cls).__new__(LgMP3File)
-		elif fext == ".flac":
-			del fext
-			return super(LgFile, cls).__new__(LgFlacFile)
-		elif fext == ".ogg":
-			del fext
-			return super(LgFile, cls).__new__(LgOggFile)
-		elif fext == ".wv":
-			del fext
-			return super(LgFile, cls).__new__(LgWavpackFile)
-		else:
-			del fext
+		# Map the extension to its class through _EXT_TO_CLASS,
+		# filled in at the end of this module.
+		fext_class = LgAudioFile._EXT_TO_CLASS.get(fext)
+		if fext_class is None:
 			error("Unhandled audio file type:\n\t%s", fentry.path)
 			raise LgException(LgErr.EINVFORMAT, fentry)
+		return super(LgFile, cls).__new__(fext_class)
 			
 	def __init__(self, fentry, opts):
 		super().__init__(fentry, opts)
-		self.verify_cmd = None
-		self.verify_cmd_args = None
 		self.mutagen_handle = None
-		self.tgain_tag_key = "replaygain_track_gain"
-		self.tpeak_tag_key = "replaygain_track_peak"
-		self.again_tag_key = "replaygain_album_gain"
-		self.apeak_tag_key = "replaygain_album_peak"
-		self.reflvl_tag_key = "replaygain_reference_loudness"
+		# File's mtime, see verify()
+		self.mtime = None
+		try:
+			self.mutagen_handle = self.mutagen_class(self.fentry.path)
+		except MutagenError as err:
+			self.mutagen_handle = None
+			# Unless we were asked to check it, we got here by trusting
+			# the file's extension (see get_type()), so this may not
+			# be an audio file at all, report it as libmagic would.
+			if not LgOpts.OFORCECHECK in opts:
+				error("Mutagen failed to open file, treating it as invalid:\n\t%s\n\t(%s)",
+				      self.fentry.path, str(err))
+				raise LgException(LgErr.EINVFORMAT, self.fentry)
+			error("Mutagen failed to open file, treating tags as invalid:\n\t%s\n\t(%s)",
+			      self.fentry.path, str(err))
+			raise LgException(LgErr.EINVTAGS, self.fentry)
 
 
 	def __enter__(self):
 		return self
 
 	def __exit__(self, exc_type, exc_value, traceback):
-		# Remove references to fentry and opts
-		# and clean up the memory of the local
-		# variables.
+		# Drop our references to fentry, opts and the
+		# mutagen handle, a dead file won't need them.
 		self.fentry = None
-		del self.fentry
 		self.options = None
-		del self.options
-		del self.verify_cmd
-		del self.verify_cmd_args
-		del self.mutagen_handle
-		del self.tgain_tag_key
-		del self.tpeak_tag_key
-		del self.again_tag_key
-		del self.apeak_tag_key
-		del self.reflvl_tag_key
+		self.mutagen_handle = None
 		# Become a dead file
-		self.__class__ = _LgRipAudioFile
+		self._dead = True
 		return True
 		
 	def verify_bitrate(self):
+		self._check_alive()
 		if self.mutagen_handle.info.bitrate < LgConsts.MIN_BRATE:
 			error("Bitrate below threshold (%i):\n\t%s",
 			      self.mutagen_handle.info.bitrate, self.fentry.path)
@@ -437,6 +568,7 @@ class LgAudioFile(LgFile):
 			return LgErr.EOK
 
 	def verify_sampling_rate(self):
+		self._check_alive()
 		if self.mutagen_handle.info.sample_rate < LgConsts.MIN_SRATE:
 			error("Sample rate below threshold (%i):\n\t%s",
 			      self.mutagen_handle.info.sample_rate, self.fentry.path)
@@ -445,12 +577,18 @@ class LgAudioFile(LgFile):
 			return LgErr.EOK
 
 	def verify(self, force = False):
+		self._check_alive()
+		# DirEntry caches the result of stat(), that's fine for files we
+		# didn't touch but after update_rgain_values() saved new tags the
+		# cached mtime is stale, so that one records the new mtime here
+		# and we never go back to DirEntry's.
+		if self.mtime is None:
+			self.mtime = int(self.fentry.stat().st_mtime)
+		mtime = self.mtime
+
 		if not LgOpts.OFORCECHECK in self.options or force:
-			stat = self.fentry.stat()
-			mtime = int(stat.st_mtime)
-			check_ts = LgFile.get_verification_ts_from_xattrs(self.fentry)
+			check_ts = LgFile.get_verification_ts_from_xattrs(self.fentry, mtime)
 			if check_ts is not None and mtime == check_ts:
-				del stat, mtime, check_ts
 				return LgErr.EOK
 		
 		ret = self.verify_bitrate()
@@ -461,112 +599,67 @@ class LgAudioFile(LgFile):
 		if ret is not LgErr.EOK:
 			return ret
 
-		del ret
 		
+		cmd_path = self._get_verify_cmd_path()
+		if cmd_path is None:
+			raise LgException(LgErr.EMISSINGTOOL, self.fentry)
+
 		try:
-			check_call([self.verify_cmd] + [self.verify_cmd_args] + [self.fentry.path],
-				   stdout=DEVNULL, stderr=DEVNULL)
-		except CalledProcessError as err:
+			# Our fds are non-inheritable anyway, with close_fds=False
+			# and an absolute path for the tool, subprocess can use
+			# posix_spawn() instead of fork()ing the whole interpreter.
+			check_call([cmd_path, self.verify_cmd_args, self.fentry.path],
+				   stdout=DEVNULL, stderr=DEVNULL, close_fds=False)
+		except FileNotFoundError:
 			# If a needed tool doesn't exist raise an exception
-			if hasattr(err, "errno") and err.errno == errno.ENOENT:
-				del err
-				raise LgException(LgErr.EMISSINGTOOL, self.fentry)
-			else:
-				# Check failed
-				error("Integrity check failed:\n\t%s", self.fentry.path)
-				del err
-				return LgErr.ECORRUPTED
+			raise LgException(LgErr.EMISSINGTOOL, self.fentry)
+		except CalledProcessError:
+			# Check failed
+			error("Integrity check failed:\n\t%s", self.fentry.path)
+			return LgErr.ECORRUPTED
 		# Check passed
 		debug("File verified:\n\t%s", self.fentry.path)
 		if not LgOpts.ODRYRUN in self.options:
-			LgFile.update_verification_ts_on_xattrs(self.fentry)
+			LgFile.update_verification_ts_on_xattrs(self.fentry, mtime)
 		return LgErr.EOK
 				
+	@classmethod
+	def _get_verify_cmd_path(cls):
+		# Check the class' own dict, not the inherited value, each
+		# format has its own tool. Don't cache a failed lookup, the
+		# tool may get installed while we run.
+		cmd_path = cls.__dict__.get("_verify_cmd_path")
+		if cmd_path is None:
+			cmd_path = which(cls.verify_cmd)
+			if cmd_path is not None:
+				cls._verify_cmd_path = cmd_path
+		return cmd_path
+
 	def get_albuminfo(self):
-		num_discs = None
-		num_tracks = None
-		album_id = None
-		album_gain = None
-		releasegroup_id = None
-		
-		# OGG/FLAC Total number of disks 
-		num_discs = self.mutagen_handle.tags.get('DISCTOTAL')
-		if num_discs is None:	# ID3 Number of disks (position in set)
-			num_discs = self.mutagen_handle.tags.get('TPOS')
-			if num_discs is None:	# APEv2 TPOS equivalent
-				num_disks = self.mutagen_handle.tags.get('Disc')
-				if num_discs is None:	# Mutagen's EasyID3 representation
-					num_discs = self.mutagen_handle.tags.get('Discnumber')
-					if num_discs is not None:
-						num_discs = num_discs[0]
-			if num_discs is not None:
-				try:
-					num_discs = int(str(num_discs).split('/')[1])
-				except IndexError:
-					pass
-		else:
-			num_discs = int(num_discs[0])
-
-		# OGG/FLAC Total number of tracks 
-		num_tracks = self.mutagen_handle.tags.get('TRACKTOTAL')
-		if num_tracks is None:	# ID3 Number of tracks
-			num_tracks = self.mutagen_handle.tags.get('TRCK')
-			if num_tracks is None:	# APEv2 TRCK equivalent
-				num_tracks = self.mutagen_handle.tags.get('Track')
-				if num_tracks is None:	# Mutagen's EasyID3 representation
-					num_tracks = self.mutagen_handle.tags.get('Tracknumber')
-					if num_tracks is not None:
-						num_tracks = num_tracks[0]
-			if num_tracks is not None:
-				try:
-					num_tracks = int(str(num_tracks).split('/')[1])
-				except IndexError:
-					pass
-		else:
-			num_tracks = int(num_tracks[0])
-
-		# OGG/FLAC/APEv2/EasyMP3 Musicbrainz Album ID
-		album_id = self.mutagen_handle.tags.get('musicbrainz_albumid')
-		if album_id is None:
-			# ID3 Musicbrainz Album ID in TXXX form
-			album_id = self.mutagen_handle.tags.get('TXXX:MusicBrainz Album Id')
-			if album_id is not None:
-				album_id = album_id[0]
-		else:
-			album_id = album_id[0]
+		self._check_alive()
+		# Grab the tags once, we'll query them a lot below
+		tags = self.mutagen_handle.tags
 
+		num_discs = _get_total_from_tags(tags, _DISCTOTAL_KEYS)
+		num_tracks = _get_total_from_tags(tags, _TRACKTOTAL_KEYS)
+		album_id = _get_first_from_tags(tags, _ALBUMID_KEYS)
+		album_gain = _get_first_from_tags(tags, _ALBUMGAIN_KEYS)
+		releasegroup_id = _get_first_from_tags(tags, _RELEASEGROUPID_KEYS)
 
-		# OGG/FLAC/APEv2/EasyMP3 Replaygain album gain
-		album_gain = self.mutagen_handle.tags.get('replaygain_album_gain')
-		if album_gain is None:
-			# ID3 Album gain in TXXX form
-			album_gain = self.mutagen_handle.tags.get('TXXX:replaygain_album_gain')
-			if album_gain is not None:
-				album_gain = album_gain[0]
-		else:
-			album_gain = album_gain[0]
-
-		# OGG/FLAC/APEv2/EasyMP3 Replaygain album gain
-		releasegroup_id = self.mutagen_handle.tags.get('musicbrainz_releasegroupid')
-		if releasegroup_id is None:
-			# ID3 Album gain in TXXX form
-			releasegroup_id = self.mutagen_handle.tags.get('TXXX:MusicBrainz Release Group Id')
-			if releasegroup_id is not None:
-				releasegroup_id = releasegroup_id[0]
-		else:
-			releasegroup_id = releasegroup_id[0]
-			
 		return num_discs, num_tracks, album_id, album_gain, releasegroup_id
 
 	def get_rgain_values(self):
-		tgain = self.mutagen_handle.tags.get(self.tgain_tag_key)
-		tpeak = self.mutagen_handle.tags.get(self.tpeak_tag_key)
-		again = self.mutagen_handle.tags.get(self.again_tag_key)
-		apeak = self.mutagen_handle.tags.get(self.apeak_tag_key)
-		ref_lvl = self.mutagen_handle.tags.get(self.reflvl_tag_key)
+		self._check_alive()
+		tags = self.mutagen_handle.tags
+		tgain = tags.get(self.tgain_tag_key)
+		tpeak = tags.get(self.tpeak_tag_key)
+		again = tags.get(self.again_tag_key)
+		apeak = tags.get(self.apeak_tag_key)
+		ref_lvl = tags.get(self.reflvl_tag_key)
 		return tgain, tpeak, again, apeak, ref_lvl
 
 	def update_rgain_values(self, track_gain, track_peak, album_gain, album_peak, ref_lvl):
+		self._check_alive()
 
 		if LgOpts.ODRYRUN in self.options:
 			return LgErr.EOK
@@ -581,17 +674,24 @@ class LgAudioFile(LgFile):
 		if ret is not LgErr.EOK:
 			return ret
 
-		self.mutagen_handle.tags[self.tgain_tag_key] = ("%.8f dB" % track_gain)
-		self.mutagen_handle.tags[self.tpeak_tag_key] = ("%.8f" % track_peak)
-		self.mutagen_handle.tags[self.reflvl_tag_key] = ("%.1f dB" % ref_lvl)
+		# Gather the new values and hand them to mutagen in one go
+		rgain_tags = {
+			self.tgain_tag_key: _RGAIN_GAIN_FMT(track_gain),
+			self.tpeak_tag_key: _RGAIN_PEAK_FMT(track_peak),
+			self.reflvl_tag_key: _RGAIN_REFLVL_FMT(ref_lvl),
+			}
 
 		if album_gain is not None and album_peak is not None:
-			self.mutagen_handle.tags[self.again_tag_key] = ("%.8f dB" % album_gain)
-			self.mutagen_handle.tags[self.apeak_tag_key] = ("%.8f" % album_peak)
+			rgain_tags[self.again_tag_key] = _RGAIN_GAIN_FMT(album_gain)
+			rgain_tags[self.apeak_tag_key] = _RGAIN_PEAK_FMT(album_peak)
+
+		self.mutagen_handle.tags.update(rgain_tags)
 
 		# Note that the above will modify mtime but we'll re-verify this file
-		# after saving the tags anyway, since mutagen may corrupt it while
-		# adding new tags (better safe than sorry).
+		# after saving the tags anyway, unless they were rewritten in place
+		# (see below), since mutagen may corrupt it while making room for
+		# them (better safe than sorry).
+		old_size = self.fentry.stat().st_size
 		try:
 			self.mutagen_handle.save()
 		except MutagenError as err:
@@ -600,21 +700,25 @@ class LgAudioFile(LgFile):
 			return LgErr.ERGAIN
 
 		info("Updated ReplayGain info:\n\t%s", self.fentry.path) 
-		return self.verify(force = True)
-
-#
-# A dead audio file
-#
-
-class _LgRipAudioFile(_LgRipFile):
-	def verify_bitrate(self):
-		raise LgException(LgErr.ERIP, None)
 
-	def verify_sampling_rate(self):
-		raise LgException(LgErr.ERIP, None)
+		# For formats with a padded tag block ahead of the audio (FLAC,
+		# ID3v2), if the file size didn't change the new tags fit in the
+		# existing padding, mutagen rewrote them in place and the audio
+		# data didn't move, so there's nothing new for the integrity
+		# checker to look at. We still need to record the new mtime as
+		# verified though. Other formats (e.g. Ogg, where rewriting the
+		# comment may repaginate the stream) always get re-verified, an
+		# unchanged size doesn't mean much there.
+		new_stat = os_stat(self.fentry.path)
+		self.mtime = int(new_stat.st_mtime)
+		if (self.tags_padded_in_place and new_stat.st_size == old_size and
+		    not LgOpts.OFORCECHECK in self.options):
+			debug("Tags updated in place, skipping verification:\n\t%s",
+			      self.fentry.path)
+			LgFile.update_verification_ts_on_xattrs(self.fentry, self.mtime)
+			return LgErr.EOK
 
-	def get_albuminfo(self):
-		raise LgException(LgErr.ERIP, None)
+		return self.verify(force = True)
 
 #
 # Audio file subclasses
@@ -622,79 +726,80 @@ class _LgRipAudioFile(_LgRipFile):
 
 class LgMP3File(LgAudioFile):
 
-	def __init__(self, fentry, opts):
-		super().__init__(fentry, opts)
-		self.verify_cmd = "mpck"
-		self.verify_cmd_args = "-q"			
-		try:
-			self.mutagen_handle = EasyMP3(self.fentry.path)
-		except MutagenError as err:
-			self.mutagen_handle = None
-			error("Mutagen failed to open file, treating tags as invalid:\n\t%s\n\t(%s)",
-			      self.fentry.path, str(err))
-			raise LgException(LgErr.EINVTAGS, self.fentry)
-		else:
-			eid3 = self.mutagen_handle.tags
-			eid3.RegisterTXXXKey(("TXXX:%s" % self.tgain_tag_key), self.tgain_tag_key)
-			self.tgain_tag_key = ("TXXX:%s" % self.tgain_tag_key)
-			
-			eid3.RegisterTXXXKey(("TXXX:%s" % self.tpeak_tag_key), self.tpeak_tag_key)
-			self.tpeak_tag_key = ("TXXX:%s" % self.tpeak_tag_key)
-
-			eid3.RegisterTXXXKey(("TXXX:%s" % self.again_tag_key), self.again_tag_key)
-			self.again_tag_key = ("TXXX:%s" % self.again_tag_key)
-
-			eid3.RegisterTXXXKey(("TXXX:%s" % self.apeak_tag_key), self.apeak_tag_key)
-			self.apeak_tag_key = ("TXXX:%s" % self.apeak_tag_key)
-
-			eid3.RegisterTXXXKey(("TXXX:%s" % self.reflvl_tag_key), self.reflvl_tag_key)
-			self.reflvl_tag_key = ("TXXX:%s" % self.reflvl_tag_key)
-			del eid3
+	__slots__ = ()
+
+	verify_cmd = "mpck"
+	verify_cmd_args = "-q"
+	mutagen_class = EasyMP3
+	tags_padded_in_place = True
+
+	# EasyID3 maps the plain replaygain_* keys to RVA2 frames, we use
+	# TXXX frames instead, through the keys registered below.
+	tgain_tag_key = "TXXX:" + LgAudioFile.tgain_tag_key
+	tpeak_tag_key = "TXXX:" + LgAudioFile.tpeak_tag_key
+	again_tag_key = "TXXX:" + LgAudioFile.again_tag_key
+	apeak_tag_key = "TXXX:" + LgAudioFile.apeak_tag_key
+	reflvl_tag_key = "TXXX:" + LgAudioFile.reflvl_tag_key
+
+# EasyID3's key registry is global, so we only need to register
+# our TXXX keys once instead of every time we open an MP3 file.
+for key, desc in ((LgMP3File.tgain_tag_key, LgAudioFile.tgain_tag_key),
+		  (LgMP3File.tpeak_tag_key, LgAudioFile.tpeak_tag_key),
+		  (LgMP3File.again_tag_key, LgAudioFile.again_tag_key),
+		  (LgMP3File.apeak_tag_key, LgAudioFile.apeak_tag_key),
+		  (LgMP3File.reflvl_tag_key, LgAudioFile.reflvl_tag_key)):
+	EasyID3.RegisterTXXXKey(key, desc)
+del key, desc
 
 class LgFlacFile(LgAudioFile):
 
-	def __init__(self, fentry, opts):
-		super().__init__(fentry, opts)
-		self.verify_cmd = "flac"
-		self.verify_cmd_args = "-t"
-		try:
-			self.mutagen_handle = FLAC(self.fentry.path)
-		except MutagenError as err:
-			self.mutagen_handle = None
-			error("Mutagen failed to open file, treating tags as invalid:\n\t%s\n\t(%s)",
-			      self.fentry.path, str(err))
-			raise LgException(LgErr.EINVTAGS, self.fentry)
+	__slots__ = ()
+
+	verify_cmd = "flac"
+	verify_cmd_args = "-t"
+	mutagen_class = FLAC
+	tags_padded_in_place = True
 
 	def verify_bitrate(self):
+		self._check_alive()
 		return LgErr.EOK
 				
 class LgOggFile(LgAudioFile):
 
-	def __init__(self, fentry, opts):
-		super().__init__(fentry, opts)
-		self.verify_cmd = "ogginfo"
-		self.verify_cmd_args = "-q"
-		try:
-			self.mutagen_handle = OggVorbis(self.fentry.path)
-		except MutagenError as err:
-			self.mutagen_handle = None
-			error("Mutagen failed to open file, treating tags as invalid:\n\t%s\n\t(%s)",
-			      self.fentry.path, str(err))
-			raise LgException(LgErr.EINVTAGS, self.fentry)
+	__slots__ = ()
+
+	verify_cmd = "ogginfo"
+	verify_cmd_args = "-q"
+	mutagen_class = OggVorbis
 			
 class LgWavpackFile(LgAudioFile):
 
-	def __init__(self, fentry, opts):
-		super().__init__(fentry, opts)
-		self.verify_cmd = "wvunpack"
-		self.verify_cmd_args = "-vv"
-		try:
-			self.mutagen_handle = WavPack(self.fentry.path)
-		except MutagenError as err:
-			self.mutagen_handle = None
-			error("Mutagen failed to open file, treating tags as invalid:\n\t%s\n\t(%s)",
-			      self.fentry.path, str(err))
-			raise LgException(LgErr.EINVTAGS, self.fentry)
+	__slots__ = ()
+
+	verify_cmd = "wvunpack"
+	verify_cmd_args = "-vv"
+	mutagen_class = WavPack
 
 	def verify_bitrate(self):
+		self._check_alive()
 		return LgErr.EOK
+
+#
+# Format / extension to class mappings for LgFile.__new__
+# and LgAudioFile.__new__
+#
+
+LgFile._TYPE_TO_CLASS = {
+	LgFormats.AUDIO: LgAudioFile,
+	# We have some booklets in PDF format
+	LgFormats.ARTWORK: LgArtworkFile,
+	LgFormats.TEXT: LgTextFile,
+	LgFormats.VIDEO: LgVideoFile,
+	}
+
+LgAudioFile._EXT_TO_CLASS = {
+	".mp3": LgMP3File,
+	".flac": LgFlacFile,
+	".ogg": LgOggFile,
+	".wv": LgWavpackFile,
+	}
@@ -28,21 +28,95 @@ from libguard import (
 import sqlite3
 from sqlite3 import Error
 from threading import Lock
+import time
+from os import path
 
 class LgIndexer(object):
 
+	# Albums are written to the db in batches, flush the
+	# pending ones when we have this many or when this
+	# many seconds passed since the last flush.
+	FLUSH_ROWS = 256
+	FLUSH_SECS = 1.0
+
+	# Statements we run per batch, sqlite3 keeps them compiled in
+	# each connection's statement cache as long as we pass the same
+	# strings.
+	SQL_INSERT = ("INSERT INTO albums(path, name, releasegroup_id, album_id) VALUES(?, ?, ?, ?) "
+		      "ON CONFLICT(releasegroup_id, path) DO UPDATE SET "
+		      "album_id=excluded.album_id, name=excluded.name")
+
+	# Duplicate reports, paths come back as a single string, one per line.
+	# Albums with no album id count as separate releases of their group.
+	SQL_SAME_ALBUM = ("SELECT album_id, GROUP_CONCAT(path, char(10, 9)) FROM albums "
+			  "WHERE album_id IS NOT NULL GROUP BY album_id HAVING COUNT(*) > 1")
+	SQL_MULTI_RELEASE = ("SELECT releasegroup_id, GROUP_CONCAT(path, char(10, 9)) FROM albums "
+			     "GROUP BY releasegroup_id HAVING COUNT(DISTINCT IFNULL(album_id, path)) > 1")
+
 	def __init__(self, dbfile):
-		self.db_handle = None
+		self.dbfile = dbfile
+		# See below
+		self.bulk_mode = False
+		# Serializes access to the db connection and the pending list
 		self.lock = Lock()
+		self.pending = list()
+		# Album directories we've seen, (st_dev, st_ino) -> path
+		self.seen = dict()
+		self.last_flush = time.monotonic()
 
+		# All threads share a single connection, everything we do on the
+		# db goes through self.lock anyway, so more connections wouldn't
+		# buy us any concurrency, just more cache.
+		db_handle = self._open_db_handle()
+		self.db_handle = db_handle
 		try:
-			self.db_handle = sqlite3.connect(dbfile, check_same_thread=False)
+			cur = db_handle.cursor()
+			# Page size can only be set on a new database (and not
+			# after switching to WAL), use larger pages than the
+			# default 4K.
+			cur.execute("PRAGMA page_count")
+			new_db = cur.fetchone()[0] == 0
+			if new_db:
+				cur.execute("PRAGMA page_size=8192")
+			# With WAL a commit doesn't need to fsync the db file
+			# itself, and we can live with losing the last batch
+			# on a power failure, it'll be re-indexed on next run.
+			cur.execute("PRAGMA journal_mode=WAL")
+			cur.execute("CREATE TABLE IF NOT EXISTS albums (id INTEGER PRIMARY KEY, path TEXT, name TEXT, releasegroup_id TEXT, album_id TEXT)")
+			# When populating a new (or empty) database don't sync
+			# anything to disk until we are done. If the system goes
+			# down while in bulk mode (e.g. during a checkpoint) the
+			# whole database may get corrupted, not just the last
+			# batches, so we only do this when there is nothing to
+			# lose but this run's work. In that case remove the db
+			# file and re-scan the library.
+			if not new_db:
+				cur.execute("SELECT 1 FROM albums LIMIT 1")
+				new_db = cur.fetchone() is None
+			if new_db:
+				info("Populating new database, using bulk mode")
+				self.bulk_mode = True
+				cur.execute("PRAGMA synchronous=OFF")
 		except Error as e:
 			raise LgException(LgErr.EDBERR, None, str(e))
 
+		# An album may only be indexed once per location, let sqlite
+		# enforce that so that inserts can just update existing albums.
+		# The per release group report also goes through this index.
+		# Databases created before this may have duplicate entries,
+		# drop them before creating the index.
+		query = "CREATE UNIQUE INDEX IF NOT EXISTS idx_albums_rg_path ON albums(releasegroup_id, path)"
 		try:
-			cur = self.db_handle.cursor()
-			cur.execute("CREATE TABLE IF NOT EXISTS albums (id INTEGER PRIMARY KEY, path TEXT, name TEXT, releasegroup_id TEXT, album_id TEXT)")
+			with db_handle:
+				db_handle.execute(query)
+		except sqlite3.IntegrityError:
+			warning("Removing duplicate entries from database")
+			try:
+				with db_handle:
+					db_handle.execute("DELETE FROM albums WHERE id NOT IN (SELECT MIN(id) FROM albums GROUP BY releasegroup_id, path)")
+					db_handle.execute(query)
+			except Error as e:
+				raise LgException(LgErr.EDBERR, None, str(e))
 		except Error as e:
 			raise LgException(LgErr.EDBERR, None, str(e))
 
@@ -50,54 +124,134 @@ class LgIndexer(object):
 		return self
 
 	def __exit__(self, exc_type, exc_value, traceback):
-		if self.db_handle is not None:
-			self.db_handle.close()
+		db_handle = self.db_handle
+		self.lock.acquire()
+		try:
+			self._flush(db_handle)
+		except Error as err:
+			error("Failed to write pending albums to database: %s", str(err))
+		self.lock.release()
+		# Done with bulk loading, sync everything to the db file
+		# and truncate the WAL.
+		if self.bulk_mode:
+			try:
+				db_handle.execute("PRAGMA synchronous=NORMAL")
+				db_handle.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+			except Error as err:
+				error("Failed to checkpoint database: %s", str(err))
+		# Let sqlite update its query planner statistics if
+		# it thinks they need it, this is cheap.
+		try:
+			db_handle.execute("PRAGMA optimize")
+		except Error as err:
+			debug("Got database error: %s", str(err))
+		db_handle.close()
 		del self.db_handle
-		return True
+		del self.pending
+		self.seen.clear()
+		del self.seen
+		# Let any exception from the with block through, it
+		# covers the whole library scan.
+		return False
+
+	def _open_db_handle(self):
+		# The connection is used by all worker threads (one at a
+		# time), hence check_same_thread=False.
+		try:
+			db_handle = sqlite3.connect(self.dbfile, check_same_thread=False)
+			if self.bulk_mode:
+				db_handle.execute("PRAGMA synchronous=OFF")
+			else:
+				db_handle.execute("PRAGMA synchronous=NORMAL")
+			db_handle.execute("PRAGMA temp_store=MEMORY")
+			# 64MB of page cache and memory mapped reads
+			# for up to 256MB of the db file.
+			db_handle.execute("PRAGMA cache_size=-65536")
+			db_handle.execute("PRAGMA mmap_size=268435456")
+		except Error as e:
+			raise LgException(LgErr.EDBERR, None, str(e))
+		return db_handle
+
+	# Write out pending albums, must be called with self.lock held
+	def _flush(self, db_handle):
+		if self.pending:
+			# Let the connection handle the transaction, it'll commit
+			# the batch or roll it back if anything fails.
+			with db_handle:
+				db_handle.executemany(LgIndexer.SQL_INSERT, self.pending)
+			debug("Wrote %d albums to database", len(self.pending))
+			self.pending.clear()
+		self.last_flush = time.monotonic()
+
+	# Read through the albums table and its index so that their
+	# pages are in cache before the workers start.
+	def prewarm(self):
+		db_handle = self.db_handle
+		self.lock.acquire()
+		try:
+			db_handle.execute("SELECT COUNT(*) FROM albums NOT INDEXED").fetchone()
+			db_handle.execute("SELECT COUNT(*) FROM albums INDEXED BY idx_albums_rg_path").fetchone()
+		except Error as err:
+			debug("Got database error: %s", str(err))
+		finally:
+			self.lock.release()
 
 	def add_album(self, dentry, releasegroup_id, album_id):
-		# Check if album exists
-		exists = False
+		# Just queue the album, duplicates are reported for the
+		# whole library at once through report_duplicates() and
+		# albums already on the db get updated by the INSERT (older
+		# versions didn't store album_id, this fills it in).
+		# The same directory may be reached through more than one
+		# path (e.g. a symlink on the library's top level), index it
+		# only once or it'll show up as a duplicate of itself. Store
+		# its real path so that it doesn't matter which one of them
+		# gets here first.
 		try:
-			cur = self.db_handle.cursor()
-			query = "SELECT path, album_id FROM albums WHERE releasegroup_id = ?"
-			args = (releasegroup_id,)
-			cur.execute(query, args)
-			results = cur.fetchall()
-			for result in results:
-				if result[0] == dentry.path:
-					debug("Album already exists on database (%s):\n\t%s",
-					      releasegroup_id, dentry.path)
-					exists = True
-				elif len(result) == 2 and result[1] == album_id:
-					error("Same album exists on multiple locations:\n\t%s\n\t%s",
-					      dentry.path, result[0])
-				else:
-					warning("Multiple releases of the same group:\n\t%s\n\t%s",
-						dentry.path, result[0])
-			results.clear()
-			del cur, query, args, results
+			dstat = dentry.stat()
+			dkey = (dstat.st_dev, dstat.st_ino)
+		except OSError:
+			dkey = None
+		real_path = path.realpath(dentry.path)
 
+		db_handle = self.db_handle
+		self.lock.acquire()
+		try:
+			if dkey is not None:
+				seen_path = self.seen.get(dkey)
+				if seen_path is not None:
+					# Multi-disc albums register their directory
+					# once per disc, only report actual aliases.
+					if seen_path != dentry.path:
+						debug("Album already indexed through another path:\n\t%s\n\t%s",
+						      seen_path, dentry.path)
+					return
+				self.seen[dkey] = dentry.path
+			self.pending.append((real_path, path.basename(real_path),
+					     releasegroup_id, album_id))
+			if (len(self.pending) >= LgIndexer.FLUSH_ROWS or
+			    time.monotonic() - self.last_flush >= LgIndexer.FLUSH_SECS):
+				self._flush(db_handle)
 		except Error as err:
 			debug("Got database error: %s", str(err))
 			raise LgException(LgErr.EDBERR, dentry, str(err))
+		finally:
+			self.lock.release()
 
-		if exists is True:
-			return
+		debug("Album queued for database (%s):\n\t%s", releasegroup_id, real_path)
 
-		# We need to serialize access to the db to avoid corruption
+	def report_duplicates(self):
+		db_handle = self.db_handle
 		self.lock.acquire()
 		try:
-			cur = self.db_handle.cursor()
-			query = "INSERT INTO albums(path, name, releasegroup_id) VALUES(?, ?, ?)"
-			args = (dentry.path, dentry.name, releasegroup_id)
-			cur.execute(query, args)
-			self.db_handle.commit()
-			del cur, query, args
+			self._flush(db_handle)
+			for album_id, paths in db_handle.execute(LgIndexer.SQL_SAME_ALBUM):
+				error("Same album exists on multiple locations (%s):\n\t%s",
+				      album_id, paths)
+			for releasegroup_id, paths in db_handle.execute(LgIndexer.SQL_MULTI_RELEASE):
+				warning("Multiple releases of the same group (%s):\n\t%s",
+					releasegroup_id, paths)
 		except Error as err:
 			debug("Got database error: %s", str(err))
+			raise LgException(LgErr.EDBERR, None, str(err))
+		finally:
 			self.lock.release()
-			raise LgException(LgErr.EDBERR, dentry, str(err))
-
-		self.lock.release()
-		debug("Album added to database (%s):\n\t%s", releasegroup_id, dentry.path)
@@ -48,21 +48,25 @@ class LgRgainProcessor(object):
 	def _process_tags(self, msg):
 		tags = msg.parse_tag()
 
-		def handle_tag(taglist, tag, userdata):
-			if tag == Gst.TAG_TRACK_GAIN:
-				_, self.current_track_gain = taglist.get_double(tag)
-			elif tag == Gst.TAG_TRACK_PEAK:
-				_, self.current_track_peak = taglist.get_double(tag)
-			elif tag == Gst.TAG_REFERENCE_LEVEL:
-				_, self.current_track_ref_lvl = taglist.get_double(tag)
-
-			elif tag == Gst.TAG_ALBUM_GAIN:
-				_, self.album_gain = taglist.get_double(tag)
-			elif tag == Gst.TAG_ALBUM_PEAK:
-				_, self.album_peak = taglist.get_double(tag)
-
-		tags.foreach(handle_tag, None)
-		del tags
+		# We only care about a few tags, ask for them directly
+		# instead of calling back to python for every tag with
+		# foreach().
+		found, value = tags.get_double(Gst.TAG_TRACK_GAIN)
+		if found:
+			self.current_track_gain = value
+		found, value = tags.get_double(Gst.TAG_TRACK_PEAK)
+		if found:
+			self.current_track_peak = value
+		found, value = tags.get_double(Gst.TAG_REFERENCE_LEVEL)
+		if found:
+			self.current_track_ref_lvl = value
+
+		found, value = tags.get_double(Gst.TAG_ALBUM_GAIN)
+		if found:
+			self.album_gain = value
+		found, value = tags.get_double(Gst.TAG_ALBUM_PEAK)
+		if found:
+			self.album_peak = value
         
 	def _save_current_track_results(self):
 		track_results = LgRgainTrackData(self.current_file, self.current_track_gain,
@@ -72,14 +76,12 @@ class LgRgainProcessor(object):
 		self.current_track_peak = None
 		self.current_track_ref_lvl = None
 		self.track_results.append(track_results)
-		del track_results
 		
 	def _save_album_results(self):
 		album_results = LgRgainAlbumData(self.album_gain, self.album_peak)
 		self.album_gain = None
 		self.album_peak = None
 		self.album_results = album_results
-		del album_results
 
 	def _next_file(self):
 
@@ -109,7 +111,6 @@ class LgRgainProcessor(object):
 		self.filesrc.set_property("location", fname)
 		self.current_file = fname
 		debug("ReplayGain processing started for track:\n\t%s", fname)
-		del fname
 		return True
 
 
@@ -118,21 +119,21 @@ class LgRgainProcessor(object):
 		sinkpad = self.converter.get_compatible_pad(new_pad, None)
 		if sinkpad is not None:
 			new_pad.link(sinkpad)
-			del sinkpad
 
 	def _on_pad_removed(self, decbin, old_pad):
 		peer = old_pad.get_peer()
 		if peer is not None:
 			old_pad.unlink(peer)
-			del peer
 
 	def _on_message(self, bus, msg):
 		if msg.type == Gst.MessageType.TAG:
 			self._process_tags(msg)
 		elif msg.type == Gst.MessageType.EOS:
-			# Preserve rganalysis state
+			# Preserve rganalysis state, going back to READY is
+			# enough to switch files, no need to tear down the
+			# whole pipeline on every track.
 			self.rgain_analyzer.set_locked_state(True)
-			self.pipeline.set_state(Gst.State.NULL)
+			self.pipeline.set_state(Gst.State.READY)
 			# Get results and store them to the list
 			self._save_current_track_results()
 			ret = self._next_file()
@@ -140,16 +141,13 @@ class LgRgainProcessor(object):
 				self.pipeline.set_state(Gst.State.PLAYING)
 				# For some reason, GStreamer 1.0's rganalysis element produces
 				# an error here unless a flush has been performed.
-				pad = self.rgain_analyzer.get_static_pad("src")
-				pad.send_event(Gst.Event.new_flush_start())
-				pad.send_event(Gst.Event.new_flush_stop(True))
-				del pad
+				self.rgain_src_pad.send_event(Gst.Event.new_flush_start())
+				self.rgain_src_pad.send_event(Gst.Event.new_flush_stop(True))
 			self.rgain_analyzer.set_locked_state(False)
 		elif msg.type == Gst.MessageType.ERROR:
 			self.pipeline.set_state(Gst.State.NULL)
 			err, debug = msg.parse_error()
 			msg = err.message
-			del err, debug
 			self.gloop.quit()
 			raise LgException(LgErr.ERGAIN, None, msg)
 			
@@ -167,39 +165,33 @@ class LgRgainProcessor(object):
 		decoder = self._make_pipeline_element("decodebin")
 		pipeline.add(decoder)
 		filesrc.link(decoder)
-		del filesrc
 
 		converter = self._make_pipeline_element("audioconvert")
 		pipeline.add(converter)
 		decoder.connect("pad-added", self._on_pad_added)
 		decoder.connect("pad-removed", self._on_pad_removed)
-		del decoder
 		
 		resampler = self._make_pipeline_element("audioresample")
 		pipeline.add(resampler)
 		converter.link(resampler)
 		self.converter = converter
-		del converter
 
 		rgain_analyzer = self._make_pipeline_element("rganalysis")
 		rgain_analyzer.set_property("forced", True)
 		rgain_analyzer.set_property("reference-level", LgConsts.RGAIN_REF_LVL)
 		self.rgain_analyzer = rgain_analyzer
+		self.rgain_src_pad = rgain_analyzer.get_static_pad("src")
 		pipeline.add(rgain_analyzer)
 		resampler.link(rgain_analyzer)
-		del resampler
 
 		sink = self._make_pipeline_element("fakesink")
 		pipeline.add(sink)
 		rgain_analyzer.link(sink)
-		del rgain_analyzer, sink
 
 		# Listen to the bus for messages
 		bus = pipeline.get_bus()
 		bus.add_signal_watch()
 		bus.connect("message", self._on_message)
-		del bus
-		del pipeline
 
 	def __init__(self, files = None):
 		if files is not None:
@@ -211,6 +203,7 @@ class LgRgainProcessor(object):
 		self.pipeline = None
 		self.filesrc = None
 		self.rgain_analyzer = None
+		self.rgain_src_pad = None
 		self.converter = None
 		self.current_file = None
 		self.current_track_gain = None
@@ -237,6 +230,7 @@ class LgRgainProcessor(object):
 		del self.pipeline
 		del self.filesrc
 		del self.rgain_analyzer
+		del self.rgain_src_pad
 		del self.converter
 		del self.current_file
 		del self.current_track_gain
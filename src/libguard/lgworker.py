@@ -20,70 +20,118 @@ class LgWorker:
 	@staticmethod
 	def run_forest_run(root_dentry, opts, junkyard_path, recursive, pbar = None, indexer = None):
 
-		def forest_step(parent):
-			with parent:
-				# Process parent (this) directory
-
-				# Got any errors during initialization ?
-				# Note that if we have LgErr.EIGNORE or
-				# LgErr.EUNKNOWN we 'll get an exception
-				# before we end up here.
-				if parent.should_withdraw():
-					parent.withdraw(junkyard_path)
-					return parent.get_withdraw_err()
-
-				# The main thing, errors on arange() and
-				# update() are non-fatal, errors on verify()
-				# are fatal and lead to withdrawal of this
-				# directory from the library.
-				parent.arange()
-				parent.update()
-				parent.verify()
-
-				# Did we get a fatal error above ?
-				if parent.should_withdraw():
-					parent.withdraw(junkyard_path)
-					return parent.get_withdraw_err()
-
-				if not recursive:
-					return LgErr.EOK
-
-				# Go through the subdirs recursively
-				direntries = scandir(parent.get_path())
-				for child_dentry in direntries:
-					if child_dentry.is_dir(follow_symlinks = False):
-						try:
-							child = LgDirectory(child_dentry, parent, opts)
-							forest_step(child)
-							# Returning from forest_step finalizes
-							# dentry, del it from here as well
-							del child, child_dentry
-						except LgException as err:
-							pass
-				del direntries
-
-				# Do we need to move this folder to junk due to
-				# a failed sub-dir (e.g. this is a multi-disc
-				# release and one of the discs failed ) ?
-				if parent.should_withdraw():
-					parent.withdraw(junkyard_path)
-					return parent.get_withdraw_err()
-
-				# Register this directory on the database
-				parent.register(indexer)
-				return LgErr.EOK
+		# Process a directory before going through its subdirs, returns
+		# the iterator over its entries if we should go through them, or
+		# None if we are done with it, along with its status.
+		def forest_step_in(parent):
+			# Process parent (this) directory
+
+			# Got any errors during initialization ?
+			# Note that if we have LgErr.EIGNORE or
+			# LgErr.EUNKNOWN we 'll get an exception
+			# before we end up here.
+			if parent.should_withdraw():
+				parent.withdraw(junkyard_path)
+				return None, parent.get_withdraw_err()
+
+			# The main thing, errors on arange() and
+			# update() are non-fatal, errors on verify()
+			# are fatal and lead to withdrawal of this
+			# directory from the library.
+			parent.arange()
+			parent.update()
+			parent.verify()
+
+			# Did we get a fatal error above ?
+			if parent.should_withdraw():
+				parent.withdraw(junkyard_path)
+				return None, parent.get_withdraw_err()
+
+			if not recursive:
+				return None, LgErr.EOK
+
+			return scandir(parent.get_path()), LgErr.EOK
+
+		# Finish processing a directory after we went through its subdirs
+		def forest_step_out(parent):
+			# Do we need to move this folder to junk due to
+			# a failed sub-dir (e.g. this is a multi-disc
+			# release and one of the discs failed ) ?
+			if parent.should_withdraw():
+				parent.withdraw(junkyard_path)
+				return parent.get_withdraw_err()
+
+			# Register this directory on the database
+			parent.register(indexer)
+			return LgErr.EOK
 
 		try:
 			root = LgDirectory(root_dentry, None, opts)
 		except LgException as err:
 			return err.error
 
-		ret = forest_step(root)
+		# Walk the tree depth-first using our own stack instead of recursing,
+		# each entry holds a directory we are in and the iterator over its
+		# entries. A directory stays entered (as in with dir:) until we are done
+		# with its subdirs, since they refer to their parent.
+		stack = list()
+		node = root
+		ret = LgErr.EOK
+		while True:
+			try:
+				if node is not None:
+					entering, node = node, None
+					entering.__enter__()
+					stack.append([entering, None])
+					direntries, ret = forest_step_in(entering)
+					if direntries is None:
+						stack.pop()
+						entering.__exit__(None, None, None)
+					else:
+						stack[-1][1] = direntries
+
+				if not stack:
+					break
+
+				parent, direntries = stack[-1]
+				child_dentry = next(direntries, None)
+				if child_dentry is None:
+					direntries.close()
+					ret = forest_step_out(parent)
+					stack.pop()
+					parent.__exit__(None, None, None)
+				elif child_dentry.is_dir(follow_symlinks = False):
+					try:
+						node = LgDirectory(child_dentry, parent, opts)
+					except LgException as err:
+						pass
+			except LgException as err:
+				# Processing of the directory on top failed, leave it
+				# and let its parent go on with the rest of its subdirs.
+				# If it's the root directory, let the caller know.
+				if not stack:
+					raise
+				failed, direntries = stack.pop()
+				if direntries is not None:
+					direntries.close()
+				failed.__exit__(type(err), err, err.__traceback__)
+				if not stack:
+					raise
+			except BaseException as err:
+				# Anything else is fatal, leave all directories
+				while stack:
+					failed, direntries = stack.pop()
+					if direntries is not None:
+						direntries.close()
+					failed.__exit__(type(err), err, err.__traceback__)
+				raise
+
 		if pbar is not None:
 			msg = "Last sub-directory: " + root_dentry.name
-			pbar.display(msg, 1)
-			del msg
-			pbar.update(1)
+			# The main thread grows the bar's total while
+			# we run, serialize with it.
+			with pbar.get_lock():
+				pbar.display(msg, 1)
+				pbar.update(1)
 
-		del root
 		return ret
@@ -15,70 +15,137 @@ from libguard.lgworker import LgWorker
 from libguard import LgOpts
 import sys
 import logging
+from logging.handlers import (
+	QueueHandler,
+	QueueListener
+)
+from queue import SimpleQueue
+import atexit
 from gi.repository import Gst
 from os import (
 	scandir,
-	path
+	stat,
+	path,
+	environ
+)
+from stat import S_ISDIR
+from libguard import (
+	LgErr,
+	LgException,
+	lg_get_num_cpus
 )
-from pathlib import Path
-from libguard import LgErr
 from libguard.lgindexer import LgIndexer
 import time
 import concurrent.futures
 from tqdm import tqdm
 
+# Stand-in for the DirEntry of the library directory, scandir() only
+# gives us entries for a directory's contents and scanning the parent
+# just to find this one is a waste, so stat() it directly instead.
+class _RootDirEntry(object):
+
+	__slots__ = ("path", "name", "_stat")
+
+	def __init__(self, abs_path):
+		self.path = abs_path
+		self.name = path.basename(abs_path)
+		self._stat = stat(abs_path)
+
+	def stat(self, follow_symlinks = True):
+		return self._stat
+
+	def inode(self):
+		return self._stat.st_ino
+
+	def is_dir(self, follow_symlinks = True):
+		return S_ISDIR(self._stat.st_mode)
+
+	def is_file(self, follow_symlinks = True):
+		return False
+
+	def is_symlink(self):
+		return False
+
+# Get the i-th command line argument if it's a directory, with
+# a single stat() and none if it wasn't given.
+def _get_dir_arg(i, default):
+	try:
+		if S_ISDIR(stat(sys.argv[i]).st_mode):
+			return sys.argv[i]
+	except (IndexError, OSError):
+		pass
+	return default
+
+# Number of directories to process in parallel, most of the time goes
+# to I/O and external tools so use twice the CPUs we may run on. Can be
+# overridden through LIBGUARD_WORKERS.
+def _get_num_workers():
+	num_workers = environ.get("LIBGUARD_WORKERS")
+	if num_workers is not None:
+		try:
+			return max(1, int(num_workers))
+		except ValueError:
+			logging.warning("Invalid LIBGUARD_WORKERS: %s", num_workers)
+	return max(2, min(32, lg_get_num_cpus() * 2))
+
+# Process one of the library's top-level entries, we check if it's a
+# directory here so that any stat() is_dir() needs happens on the pool.
+def _process_entry(entry, opts, junk_path, pbar, indexer):
+	if not entry.is_dir():
+		with pbar.get_lock():
+			pbar.update(1)
+		return LgErr.EOK
+	return LgWorker.run_forest_run(entry, opts, junk_path, True, pbar, indexer)
+
 if __name__ == '__main__':
 	#opts = LgOpts.ODRYRUN | LgOpts.OFORCECHECK | LgOpts.OFORCERGAIN
 	opts = LgOpts.DEFAULT
 	Gst.init()
-	log_level = logging.INFO
-
-	if len(sys.argv) > 1 and path.isdir(sys.argv[1]):
-		libpath = sys.argv[1]
-	else:
-		libpath = "."
-
-	if len(sys.argv) > 2 and path.isdir(sys.argv[2]):
-		junk_path = sys.argv[2]
-	else:
-		junk_path = "./.junk"
-
-	if len(sys.argv) > 3 and path.isdir(sys.argv[3]):
-		log_path = sys.argv[3]
+	# Set LIBGUARD_DEBUG (to anything) for debug logging, this
+	# also makes us process the library in alphabetical order.
+	if environ.get("LIBGUARD_DEBUG"):
+		log_level = logging.DEBUG
 	else:
-		log_path = "/tmp/libguard.log"
+		log_level = logging.INFO
 
-	if len(sys.argv) > 4 and path.isdir(sys.argv[4]):
-		db_path = sys.argv[4]
-	else:
-		db_path = "/tmp/libguard_index.db"
+	libpath = _get_dir_arg(1, ".")
+	junk_path = _get_dir_arg(2, "./.junk")
+	log_path = _get_dir_arg(3, "/tmp/libguard.log")
+	db_path = _get_dir_arg(4, "/tmp/libguard_index.db")
 		
-	print('\033[96m'"Library Guardian starting...")
-	print('\033[95m'"Library path:\t", libpath)
-	print('\033[95m'"Logfile at:\t", log_path)
-	print('\033[95m'"Junkyard:\t", junk_path)
 	start_time = time.monotonic()
-	print('\033[92m'"Started on", time.ctime())
+	start_ctime = time.ctime()
+	sys.stdout.write('\033[96m'"Library Guardian starting...\n"
+			 '\033[95m'"Library path:\t %s\n"
+			 '\033[95m'"Logfile at:\t %s\n"
+			 '\033[95m'"Junkyard:\t %s\n"
+			 '\033[92m'"Started on %s\n" %
+			 (libpath, log_path, junk_path, start_ctime))
 
-	logging.basicConfig(filename = log_path, level = log_level)
-	logging.info("Library Guardian starting...")
-	logging.info("Library path: %s", libpath)
-	logging.info("Junkyard: %s", junk_path)
-	logging.info("Started on %s", time.ctime())
+	# Workers just queue their log records, a single thread writes
+	# them to the log file so that they don't wait on each other
+	# (and the disk) every time they log something.
+	log_queue = SimpleQueue()
+	log_listener = QueueListener(log_queue, logging.FileHandler(log_path))
+	logging.basicConfig(level = log_level, handlers = [QueueHandler(log_queue)])
+	log_listener.start()
+	atexit.register(log_listener.stop)
+	logging.info("Library Guardian starting...\n"
+		     "\tLibrary path: %s\n"
+		     "\tJunkyard: %s\n"
+		     "\tStarted on %s", libpath, junk_path, start_ctime)
+	num_workers = _get_num_workers()
+	logging.info("Using %d workers", num_workers)
 	# We want to check the given path as well, not only its subdirectories
-	# and since scandir() only gives us the contents of the provided dir
-	# we need to go one level above and grab the direntry for the provided
-	# path.
 	abs_path = path.realpath(libpath)
-	path_handle = Path(abs_path)
-	root_dentry = None
-	for entry in scandir(path_handle.parent):
-		if entry.path == abs_path:
-			root_dentry = entry
-			break
-
-	if root_dentry is None:
-		logging.error("Couldn't get parent directory !")
+	try:
+		root_dentry = _RootDirEntry(abs_path)
+	except OSError as err:
+		logging.error("Couldn't access library directory: %s", str(err))
+		sys.exit(LgErr.EINVPATH)
+
+	if not root_dentry.is_dir():
+		logging.error("Library path is not a directory !")
 		sys.exit(LgErr.EINVPATH)
 
 	# Deal with the provided directory non-recursively first
@@ -86,21 +153,60 @@ if __name__ == '__main__':
 	if ret is not LgErr.EOK:
 		sys.exit(ret)
 
-	# Deal with its subdirectories, if this is a library directory
-	# it should have plenty, so using multiprocessing makes sense.
-	with concurrent.futures.ThreadPoolExecutor(max_workers = 4) as executor:
-		# For easier debugging sort them alphabeticaly
-		direntries = sorted(scandir(root_dentry.path), key=lambda e: e.name)
-		with tqdm(total = len(direntries)) as pbar:
-			with LgIndexer(db_path) as indexer:
+	# Open the indexer before we start the workers, so that the db
+	# is ready (and its pages cached) by the time they need it.
+	with LgIndexer(db_path) as indexer:
+		indexer.prewarm()
+
+		# Deal with its subdirectories, if this is a library directory
+		# it should have plenty, so process them in parallel. We use
+		# threads, not processes, the heavy lifting (file I/O, external
+		# verification tools, GStreamer) runs without holding the GIL and
+		# threads are much lighter. Keep it that way, avoid pure-python
+		# CPU loops on the workers' path.
+		with concurrent.futures.ThreadPoolExecutor(max_workers = num_workers,
+							   thread_name_prefix = "lg-dir") as executor:
+			# Hand entries to the workers as scandir() returns them
+			# instead of waiting for the whole listing, the progress
+			# bar's total grows as we go. Workers update it from many
+			# threads, redrawing it twice a second is plenty.
+			with tqdm(total = 0, mininterval = 0.5) as pbar:
 				futures = list()
-				for entry in direntries:
-					if entry.is_dir():
-						futures.append(executor.submit(LgWorker.run_forest_run,
-									       entry, opts, junk_path, True, pbar, indexer))
-				executor.shutdown(wait=True)
+				with scandir(root_dentry.path) as direntries:
+					# For easier debugging process them in
+					# alphabetical order, at the cost of waiting
+					# for the whole listing.
+					entries = direntries
+					if log_level <= logging.DEBUG:
+						entries = sorted(direntries, key=lambda e: e.name)
+					for entry in entries:
+						# Workers update the bar concurrently,
+						# tqdm's lock is re-entrant.
+						with pbar.get_lock():
+							pbar.total += 1
+						futures.append(executor.submit(_process_entry,
+									       entry, opts, junk_path, pbar, indexer))
+				pbar.refresh()
+				# Wait for them to finish, a worker only raises an
+				# LgException if it failed on its top-level directory,
+				# report it and go on with the rest. Anything else is
+				# a bug, log it and raise it once everyone is done.
+				fatal_err = None
+				for future in concurrent.futures.as_completed(futures):
+					try:
+						future.result()
+					except LgException as err:
+						logging.error("Failed to process directory: %s", str(err))
+					except Exception as err:
+						logging.exception("Worker failed unexpectedly")
+						if fatal_err is None:
+							fatal_err = err
+				if fatal_err is not None:
+					raise fatal_err
 				pbar.display("", 1)
 
+		indexer.report_duplicates()
+
 	end_time =  time.monotonic()
 	elapsed_time = end_time - start_time
 	process_time = time.process_time()